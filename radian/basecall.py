@@ -1,5 +1,8 @@
 import argparse
+from collections import deque
 import json
+from multiprocessing import Pool
+import os
 from pathlib import Path
 from time import time
 
@@ -7,7 +10,7 @@ import numpy as np
 from ont_fast5_api.fast5_interface import get_fast5_file
 import pyslow5
 
-from decode import beam_search
+from decode import batched_beam_search, beam_search, index_rna_model
 from matrix_assembly import assemble_matrices, plot_assembly
 from model import get_prediction_model
 from preprocess import mad_normalise, get_windows
@@ -15,6 +18,113 @@ from sequence_assembly import simple_assembly, index2base # TODO: Rename assembl
 from utilities import get_config, setup_local
 
 
+# Decoding state of each worker process, set by init_worker
+worker_args = None
+worker_rna_model = None
+worker_rna_entropies = None
+
+
+def init_worker(args, rna_model, rna_entropies):
+    global worker_args, worker_rna_model, worker_rna_entropies
+    worker_args = args
+    # The RNA model arrays are inherited from the parent when the workers
+    # are forked, so all workers share one read-only copy of them
+    worker_rna_model = rna_model
+    worker_rna_entropies = rna_entropies
+
+
+def decode_read(matrices):
+    # Return the decoded sequence of a read and the time taken to decode it
+    args = worker_args
+    start_t = time()
+
+    # Decode CTC output (with/without RNA model, global/local)
+    if args.decode_type == "global":
+        matrix = assemble_matrices(matrices, args.step_size)
+        # plot_assembly(matrices, matrix, args.chunk_len, args.step_size)
+        sequence = beam_search(matrix,
+                               'ACGT',
+                               args.beam_width,
+                               worker_rna_model,
+                               args.sig_threshold,
+                               args.rna_threshold,
+                               args.context_len,
+                               worker_rna_entropies,
+                               args.beam_threshold,
+                               args.char_threshold)
+    else:
+        read_fragments = batched_beam_search(matrices, 'ACGT', args.beam_width)
+        consensus = simple_assembly(read_fragments)
+        sequence = index2base(np.argmax(consensus, axis=0))
+
+    return sequence, time() - start_t
+
+
+def get_reads(reads_path, io_threads=1):
+    # Yield the id and raw signal of each read in a blow5 file or fast5 directory
+    # this is a hack, just detecting the .blow5 extention to hijack the arg
+    # should do something better than this
+    if reads_path.split(".")[-1] == "blow5":
+        s5 = pyslow5.Open(reads_path, 'r')
+        # Read and decompress batches of records with multiple threads, overlapping
+        # disk reads with the rest of the basecalling
+        if io_threads > 1:
+            reads = s5.seq_reads_multi(threads=io_threads, batchsize=4096)
+        else:
+            reads = s5.seq_reads()
+        for read in reads:
+            yield read["read_id"], read["signal"]
+    else:
+        for fast5_filepath in Path(reads_path).rglob('*.fast5'):
+            with get_fast5_file(fast5_filepath, 'r') as fast5:
+                for read in fast5.get_reads():
+                    yield read.read_id, read.get_raw_data()
+
+
+def get_matrices(norm_signal, sig_model, args):
+    windows, pad = get_windows(norm_signal, args.chunk_len, args.step_size)
+
+    # Pass windows through signal model in batches
+    i = 0
+    matrices = []
+    while i + args.batch_size <= len(windows):
+        batch = windows[i:i+args.batch_size]
+        i += args.batch_size
+        matrices.extend(sig_model.predict(batch))
+    if i < len(windows):
+        matrices.extend(sig_model.predict(windows[i:]))
+
+    # Trim padding from last matrix before decoding
+    matrices[-1] = matrices[-1][:-pad]
+
+    return matrices
+
+
+class FastaWriter:
+    """Write reads to fasta files, with at most 1000 reads per file."""
+
+    def __init__(self, fasta_dir):
+        self.fasta_dir = fasta_dir
+        self.fasta_n = 0
+        self.fasta_i = 0
+        self.fasta = open(f"{fasta_dir}/reads-{self.fasta_n}.fasta", "w")
+
+    def write(self, read_id, sequence):
+        # Write read to fasta file (reverse sequence to be 5' to 3')
+        self.fasta.write(f">{read_id}\n{sequence[::-1]}\n")
+        self.fasta_i += 1
+
+        # Only write 1000 reads per fasta file
+        if self.fasta_i == 1000:
+            self.fasta.close()
+            self.fasta_n += 1
+            self.fasta = open(f"{self.fasta_dir}/reads-{self.fasta_n}.fasta", "w")
+            self.fasta_i = 0
+
+    def close(self):
+        self.fasta.close()
+
+
 def main():
     # CL args
     parser = argparse.ArgumentParser(description=("Basecall a nanopore dRNA "
@@ -30,10 +140,21 @@ def main():
     parser.add_argument("--sig-model", default="models/sig2seq.h5")
     parser.add_argument("--sig-config", default="models/sig2seq.yaml")
     parser.add_argument("--beam-width", default=6, type=int)
+    parser.add_argument("--beam-threshold", default=20.0, type=float,
+                        help=("Drop extended beams this far below the best beam (in log "
+                              "probability), only applies to --decode-type global."))
+    parser.add_argument("--char-threshold", default=1e-4, type=float,
+                        help=("Don't extend beams with bases the signal model gives a lower "
+                              "probability than this, only applies to --decode-type global."))
     parser.add_argument("--decode-type", choices=["global", "chunk"], default="global")
     parser.add_argument("--sig-threshold", default=0.5, type=float)
     parser.add_argument("--rna-threshold", default=0.5, type=float)
     parser.add_argument("--context-len", default=11, type=int)
+    parser.add_argument("--processes", default=max(1, os.cpu_count() - 1), type=int,
+                        help=("Number of processes used to decode reads (default: one "
+                              "fewer than the number of CPUs, leaving one for the signal model)."))
+    parser.add_argument("--io-threads", default=4, type=int,
+                        help="Number of threads used to read blow5 files.")
 
     args = parser.parse_args()
     # Local testing
@@ -41,182 +162,69 @@ def main():
     #                           "data",
     #                           "--local"])
 
-    # Local setup to avoid cuDNN error when running locally
-    if args.local:
-        setup_local()
-
     # Load RNA model
-    rna_model = args.rna_model
-    if rna_model != "None":
+    rna_model = None
+    rna_entropies = None
+    if args.rna_model != "None":
         with open(args.rna_model, "r") as f:
             rna_model_raw = json.load(f)
-            # Format RNA model keys to format expected by beam search decoder
-            rna_model = {}
-            for context, dist in rna_model_raw.items():
-                bases = ['A', 'C', 'G', 'T']
-                context_formatted = tuple(map(lambda b: bases.index(b), context))
-                rna_model[context_formatted] = dist
-    entropy_cache = {}
+        # Format RNA model as arrays indexed by context, as expected by beam search decoder
+        rna_model, rna_entropies = index_rna_model(rna_model_raw, 'ACGT', args.context_len)
+        del rna_model_raw
+
+    # Start the decoding workers before TensorFlow creates a session or loads the
+    # signal model, so that the forked processes share the RNA model but not the
+    # TensorFlow (or CUDA) state
+    pool = Pool(args.processes, initializer=init_worker, initargs=(args, rna_model, rna_entropies))
+
+    # Local setup to avoid cuDNN error when running locally
+    if args.local:
+        setup_local()
 
     # Load signal-to-sequence model
     sig_config = get_config(args.sig_config)
     sig_model = get_prediction_model(args.sig_model, sig_config)
 
     # Output to fasta
-    fasta_n = 0
-    fasta_i = 0
-    fasta = open(f"{args.fasta_dir}/reads-{fasta_n}.fasta", "w")
-
-    # Basecall each read in fast5 directory
-    # this is a hack, just detecting the .blow5 extention to hijack the arg
-    # should do something better than this
-    if args.fast5_dir.split(".")[-1] == "blow5":
-        SLOW5 = True
-        s5 = pyslow5.Open(args.fast5_dir, 'r')
-        # this can be multithreaded with s5.seq_reads_multi(), see docs for flags
-        reads = s5.seq_reads()
-        # this is copy/paste of below but using read_id set first rather than accessing it
-        for read in reads:
-            start_t = time()
-            read_id = read["read_id"]
-            # Preprocess read
-            raw_signal = read["signal"]
-            try:
-                norm_signal = mad_normalise(raw_signal, args.outlier_clip)
-            except ValueError as e:
-                print(e.args)
-                print(f"{read_id} signal issue, skipping this read.")
-                continue
-            windows, pad = get_windows(norm_signal, args.chunk_len, args.step_size)
-
-            # Pass windows through signal model in batches
-            i = 0
-            matrices = []
-            while i + args.batch_size <= len(windows):
-                batch = windows[i:i+args.batch_size]
-                i += args.batch_size
-                matrices.extend(sig_model.predict(batch))
-            if i < len(windows):
-                matrices.extend(sig_model.predict(windows[i:]))
-
-            # Trim padding from last matrix before decoding
-            matrices[-1] = matrices[-1][:-pad]
-
-            # Decode CTC output (with/without RNA model, global/local)
-            if args.decode_type == "global":
-                matrix = assemble_matrices(matrices, args.step_size)
-                # plot_assembly(matrices, matrix, args.chunk_len, args.step_size)
-                sequence = beam_search(matrix,
-                                        'ACGT',
-                                        args.beam_width,
-                                        rna_model,
-                                        args.sig_threshold,
-                                        args.rna_threshold,
-                                        args.context_len,
-                                        entropy_cache)
-            else:
-                read_fragments = []
-                for matrix in matrices:
-                    sequence = beam_search(matrix,
-                                            'ACGT',
-                                            args.beam_width,
-                                            None,
-                                            None,
-                                            None,
-                                            None,
-                                            None)
-                    read_fragments.append(sequence)
-                consensus = simple_assembly(read_fragments)
-                sequence = index2base(np.argmax(consensus, axis=0))
-
-            end_t = time()
-            dur = end_t - start_t
-
-            # Write read to fasta file (reverse sequence to be 5' to 3')
-            fasta.write(f">{read_id}\n{sequence[::-1]}\n")
-            fasta_i += 1
-            print(f"Basecalled read {read_id} in {dur:.2f} sec.")
-
-            # Only write 1000 reads per fasta file
-            if fasta_i == 1000:
-                fasta.close()
-                fasta_n += 1
-                fasta = open(f"{args.fasta_dir}/reads-{fasta_n}.fasta", "w")
-                fasta_i = 0
-    else:
-        for fast5_filepath in Path(args.fast5_dir).rglob('*.fast5'):
-            with get_fast5_file(fast5_filepath, 'r') as fast5:
-                for read in fast5.get_reads():
-                    start_t = time()
-                    
-                    # Preprocess read
-                    raw_signal = read.get_raw_data()
-                    try:
-                        norm_signal = mad_normalise(raw_signal, args.outlier_clip)
-                    except ValueError as e:
-                        print(e.args)
-                        print(f"{read.read_id} signal issue, skipping this read.")
-                        continue
-                    windows, pad = get_windows(norm_signal, args.chunk_len, args.step_size)
-
-                    # Pass windows through signal model in batches
-                    i = 0
-                    matrices = []
-                    while i + args.batch_size <= len(windows):
-                        batch = windows[i:i+args.batch_size]
-                        i += args.batch_size
-                        matrices.extend(sig_model.predict(batch))
-                    if i < len(windows):
-                        matrices.extend(sig_model.predict(windows[i:]))
-
-                    # Trim padding from last matrix before decoding
-                    matrices[-1] = matrices[-1][:-pad]
-
-                    # Decode CTC output (with/without RNA model, global/local)
-                    if args.decode_type == "global":
-                        matrix = assemble_matrices(matrices, args.step_size)
-                        # plot_assembly(matrices, matrix, args.chunk_len, args.step_size)
-                        sequence = beam_search(matrix,
-                                            'ACGT',
-                                            args.beam_width,
-                                            rna_model,
-                                            args.sig_threshold,
-                                            args.rna_threshold,
-                                            args.context_len,
-                                            entropy_cache)
-                    else:
-                        read_fragments = []
-                        for matrix in matrices:
-                            sequence = beam_search(matrix,
-                                                    'ACGT',
-                                                    args.beam_width,
-                                                    None,
-                                                    None,
-                                                    None,
-                                                    None,
-                                                    None)
-                            read_fragments.append(sequence)
-                        consensus = simple_assembly(read_fragments)
-                        sequence = index2base(np.argmax(consensus, axis=0))
-
-                    end_t = time()
-                    dur = end_t - start_t
-
-                    # Write read to fasta file (reverse sequence to be 5' to 3')
-                    fasta.write(f">{read.read_id}\n{sequence[::-1]}\n")
-                    fasta_i += 1
-                    print(f"Basecalled read {read.read_id} in {dur:.2f} sec.")
-
-                    # Only write 1000 reads per fasta file
-                    if fasta_i == 1000:
-                        fasta.close()
-                        fasta_n += 1
-                        fasta = open(f"{args.fasta_dir}/reads-{fasta_n}.fasta", "w")
-                        fasta_i = 0
+    fasta = FastaWriter(args.fasta_dir)
+
+    def write_next_read():
+        # Report the time spent on the read itself, excluding the time it
+        # waited for a worker behind the other reads in flight
+        read_id, signal_dur, result = pending.popleft()
+        sequence, decode_dur = result.get()
+        fasta.write(read_id, sequence)
+        dur = signal_dur + decode_dur
+        print(f"Basecalled read {read_id} in {dur:.2f} sec.")
+
+    # Run the signal model on each read and decode it in a worker process,
+    # keeping a bounded number of reads in flight
+    pending = deque()
+    for read_id, raw_signal in get_reads(args.fast5_dir, args.io_threads):
+        start_t = time()
+
+        # Preprocess read
+        try:
+            norm_signal = mad_normalise(raw_signal, args.outlier_clip)
+        except ValueError as e:
+            print(e.args)
+            print(f"{read_id} signal issue, skipping this read.")
+            continue
+        matrices = get_matrices(norm_signal, sig_model, args)
+        signal_dur = time() - start_t
+
+        pending.append((read_id, signal_dur, pool.apply_async(decode_read, (matrices,))))
+        if len(pending) > 2 * args.processes:
+            write_next_read()
+    while pending:
+        write_next_read()
+
+    pool.close()
+    pool.join()
 
     # Make sure last fasta file is closed
     fasta.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
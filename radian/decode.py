@@ -2,96 +2,101 @@
 This has been adapted from https://github.com/githubharald/CTCDecoder/blob/master/ctc_decoder/beam_search.py
 """
 
-from collections import defaultdict
-from dataclasses import dataclass
 import math
 from typing import List, Tuple
 
+from numba import njit
+from numba.typed import Dict
+from numba import types
 import numpy as np
-import tensorflow as tf
 
 
 N_BASES = 4
+HASH_PRIME = 1000003
 
 def log(x: float) -> float:
     return -math.inf if x == 0 else math.log(x)
 
 
-@dataclass
-class BeamEntry:
-    """Information about one single beam at specific time-step."""
-    pr_total: float = log(0)  # blank and non-blank
-    pr_non_blank: float = log(0)  # non-blank
-    pr_blank: float = log(0)  # blank
-    labeling: tuple = ()  # beam-labeling
+def log_dist(dist: np.ndarray) -> np.ndarray:
+    # element-wise version of log, in double precision
+    with np.errstate(divide="ignore"):
+        return np.log(dist, dtype=np.float64)
 
 
-class BeamList:
-    """Information about all beams at specific time-step."""
+def logaddexp(a: float, b: float) -> float:
+    # scalar np.logaddexp, without the overhead of a ufunc call
+    if a == -math.inf:
+        return b
+    return max(a, b) + math.log1p(math.exp(-abs(a - b)))
 
-    def __init__(self) -> None:
-        self.entries = defaultdict(BeamEntry)
 
-    def sort_labelings(self) -> List[Tuple[int]]:
-        """Return beam-labelings, sorted by probability."""
-        beams = self.entries.values()
-        sorted_beams = sorted(beams, reverse=True, key=lambda x: x.pr_total)
-        return [x.labeling for x in sorted_beams]
+def index_rna_model(model: dict, bases: str, len_context: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Store an RNA model as arrays indexed by encoded context.
 
+    A context is encoded as its bases read as digits in base len(bases), the same way beam_search
+    encodes the end of its beam-labelings.
 
-def get_context(labeling, len_context, exclude_last=False):
-    # the context is the last portion of the beam
-    if exclude_last == True:
-        context = labeling[-(len_context+1):-1]
-    else:
-        context = labeling[-len_context:]
-
-    return context
-
-
-def combine_dists(r_dist, s_dist):
-    # get the base (i.e. non-blank) distribution from the signal model
-    s_base_prob = np.sum(s_dist[:-1])
-    s_base_dist = s_dist[:-1] / s_base_prob
-
-    # average the signal and rna model probs
-    c_dist = np.add(r_dist, s_base_dist) / 2
+    Args:
+        model: Distribution of the next base by context, with contexts as strings of bases.
+        bases: The bases of the contexts, in the order of the distributions.
+        len_context: Number of bases in each context.
 
-    # reconstruct the signal model distribution (including blank)
-    c_dist = c_dist * s_base_prob
-    c_dist = np.append(c_dist, s_dist[-1])
+    Returns:
+        The distributions (of shape n_bases**len_context x n_bases) and their entropies, contexts
+        missing from the model get an entropy of inf so they are never applied.
+    """
+    n_bases = len(bases)
+    if any(len(context) != len_context for context in model):
+        raise ValueError(f"RNA model contexts are not all {len_context} bases long.")
+
+    # encode all contexts at once, from the ascii codes of their bases
+    digits = np.full(256, -1, dtype=np.int64)
+    digits[np.frombuffer(bases.encode(), dtype=np.uint8)] = np.arange(n_bases)
+    codes = digits[np.frombuffer("".join(model).encode(), dtype=np.uint8)].reshape(-1, len_context)
+    if (codes < 0).any():
+        raise ValueError(f"RNA model contexts can only contain the bases {bases}.")
+    keys = codes @ n_bases ** np.arange(len_context - 1, -1, -1)
+
+    dists = np.zeros((n_bases ** len_context, n_bases))
+    dists[keys] = np.array(list(model.values()), dtype=np.float64)
+    entropies = np.full(n_bases ** len_context, math.inf)
+    entropies[keys] = entropy(dists[keys])
+
+    return dists, entropies
+
+
+def combine_dists(r_dist, s_dist, s_base_prob=None):
+    # average the rna model probs with the base (i.e. non-blank) distribution from the signal
+    # model, scaled back to the signal model's base probability, and keep its blank prob
+    if s_base_prob is None:
+        s_base_prob = s_dist[:-1].sum()
+    c_dist = np.empty(len(s_dist))
+    c_dist[:-1] = 0.5 * (r_dist * s_base_prob + s_dist[:-1])
+    c_dist[-1] = s_dist[-1]
 
     return c_dist
 
 
-def normalise(dist):
-    if sum(dist) == 0:
-        return dist
-    return dist / sum(dist)
-
+def entropy(dists):
+    # entropy of each distribution along the last axis
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # events with probability 0 do not contribute to the entropy
+        return -np.where(dists > 0, dists * np.log(dists), 0).sum(axis=-1)
 
-def entropy(dist):
-    # Events with probability 0 do not contribute to the entropy
-    dist = dist[dist > 0]
-    return -sum([p * math.log(p) for p in dist])
 
-
-def apply_rna_model(s_dist, context, model, entr_cache, s_entropy, r_threshold, s_threshold):
+def apply_rna_model(s_dist, context_key, model, model_entropies, s_entropy, r_threshold, s_threshold,
+                    s_base_prob=None):
     if model is None:
         return s_dist
 
-    r_dist = np.asarray(model[context])
-
-    # compute the entropy of the RNA model distribution (speed up with cache)
-    if context not in entr_cache:
-        r_entropy = entropy(r_dist)
-        entr_cache[context] = r_entropy
-    else:
-        r_entropy = entr_cache[context]
+    # the RNA model is only used when the signal model is uncertain
+    if s_entropy <= s_threshold:
+        return s_dist
 
     # combine the probability distributions from the RNA and sig2seq models
-    if r_entropy < r_threshold and s_entropy > s_threshold:
-        return combine_dists(r_dist, s_dist)
+    if model_entropies[context_key] < r_threshold:
+        return combine_dists(model[context_key], s_dist, s_base_prob)
     else:
         return s_dist
 
@@ -101,21 +106,29 @@ def beam_search(
     mat: np.ndarray,
     bases: str,
     beam_width: int,
-    lm: tf.keras.Model,
+    lm: np.ndarray,
     s_threshold: int,
     r_threshold: int,
     len_context: int,
-    entr_cache: dict
+    lm_entropies: np.ndarray,
+    beam_threshold: float = 20.0,
+    char_threshold: float = 1e-4
 ) -> str:
     """Beam search decoder.
 
     See the paper of Hwang et al. and the paper of Graves et al.
 
+    The beams of each time-step are expanded by the compiled _bs_step, the RNA model is applied
+    beforehand by looking up the posteriors each beam is copied and extended with.
+
     Args:
         mat: Output of neural network of shape TxC.
         bases: The set of bases the neural network can recognize, excluding the CTC-blank.
         beam_width: Number of beams kept per iteration.
-        lm: Character level language model if specified.
+        lm: Character level language model if specified, as the distributions of index_rna_model.
+        beam_threshold: Extended beams more than this far below the best beam (in log probability) are dropped.
+        char_threshold: Beams are not extended with chars the signal model gives a lower probability than this.
+        lm_entropies: Entropies of the language model distributions, from index_rna_model.
 
     Returns:
         The decoded text.
@@ -123,90 +136,322 @@ def beam_search(
 
     blank_idx = len(bases)
     timesteps, chars = mat.shape
-
-    # initialise beam state
-    last = BeamList()
-    labeling = ()
-    last.entries[labeling] = BeamEntry()
-    last.entries[labeling].pr_blank = log(1)
-    last.entries[labeling].pr_total = log(1)
-
-    # pre-compute entropy for each timestep in the softmax matrix
-    s_entropies = []
-    for t in range(timesteps):
-        # don't include the blank symbol, so we need to first normalise
-        s_entropies.append(entropy(normalise(mat[t][:-1])))
-
-    # go over all time-steps
+    n_bases = chars - 1
+
+    log_mat = log_dist(mat)
+
+    # the end of each beam-labeling (its last len_context + 1 chars) is encoded as a leading 1
+    # followed by the chars as digits in base n_bases, so contexts can be compared and hashed
+    # as ints; these are the encoded tails holding a full context before the last char, or at
+    # least a full context, without an RNA model only the last char of each beam is needed
+    full_tail = n_bases ** (len_context + 1 if lm is not None else 1)
+    full_context = full_tail // n_bases
+
+    # pre-compute the total probability and entropy of the bases (i.e. without the blank symbol,
+    # so we need to first normalise) at each timestep
+    if lm is not None:
+        s_base_dists = mat[:, :-1]
+        s_base_probs = s_base_dists.sum(axis=1, dtype=np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            s_norm_dists = np.where(s_base_probs[:, None] > 0, s_base_dists / s_base_probs[:, None], 0)
+        s_entropies = entropy(s_norm_dists).tolist()
+        s_base_probs = s_base_probs.tolist()
+
+    # at time-steps without the RNA model all beams share the signal model posteriors
+    no_lm = np.zeros(1, dtype=np.bool_)
+
+    # initialise beam state with the empty labeling
+    last_chars = np.array([-1], dtype=np.int64)
+    last_hashes = np.array([0], dtype=np.int64)
+    last_tails = np.array([1], dtype=np.int64)  # just the leading 1
+    pr_blank = np.array([log(1)])
+    pr_non_blank = np.array([log(0)])
+    pr_total = np.array([log(1)])
+
+    # go over all time-steps, remembering where each kept beam came from
+    history = []
     for t in range(timesteps):
-        curr = BeamList()
+        copy_dists = ext_dists = log_mat[t:t+1]
+        lm_applied = no_lm
+
+        # the RNA model is only consulted when the signal model is uncertain
+        if lm is not None and s_entropies[t] > s_threshold:
+            s_dist = mat[t]
+            s_entropy = s_entropies[t]
+            s_base_prob = s_base_probs[t]
+            log_s_dist = log_mat[t]
+            # log posteriors after applying the RNA model, by encoded context (only valid for this time-step)
+            dist_cache = {}
+
+            n_last = len(last_tails)
+            copy_dists = np.empty((n_last, chars))
+            ext_dists = np.empty((n_last, chars))
+            lm_applied = np.zeros(n_last, dtype=np.bool_)
+            for i, tail in enumerate(last_tails.tolist()):
+                # the RNA model needs a full context, and the copy step excludes the last char from it
+                log_pr_dist = log_s_dist
+                if tail >= full_tail:
+                    # TODO: Add comment on why we exclude last
+                    context_key = tail // n_bases % full_context
+                    # TODO: Reconsider if RNA model should be applied here
+                    log_pr_dist = dist_cache.get(context_key)
+                    if log_pr_dist is None:
+                        pr_dist = apply_rna_model(s_dist, context_key, lm, lm_entropies, s_entropy, r_threshold,
+                                                  s_threshold, s_base_prob)
+                        log_pr_dist = log_s_dist if pr_dist is s_dist else log_dist(pr_dist)
+                        dist_cache[context_key] = log_pr_dist
+                copy_dists[i] = log_pr_dist
+
+                log_pr_dist = log_s_dist
+                if tail >= full_context:
+                    context_key = tail % full_context
+                    log_pr_dist = dist_cache.get(context_key)
+                    if log_pr_dist is None:
+                        pr_dist = apply_rna_model(s_dist, context_key, lm, lm_entropies, s_entropy, r_threshold,
+                                                  s_threshold, s_base_prob)
+                        log_pr_dist = log_s_dist if pr_dist is s_dist else log_dist(pr_dist)
+                        dist_cache[context_key] = log_pr_dist
+                ext_dists[i] = log_pr_dist
+                lm_applied[i] = log_pr_dist is not log_s_dist
+
+        parents, new_chars, last_chars, last_hashes, last_tails, pr_blank, pr_non_blank, pr_total = _bs_step(
+            log_mat[t], copy_dists, ext_dists, lm_applied, last_chars, last_hashes, last_tails,
+            pr_blank, pr_non_blank, pr_total, beam_width, beam_threshold, log(char_threshold), blank_idx,
+            chars, full_tail)
+        history.append((parents, new_chars))
+
+    # trace the best beam back to the first time-step
+    beam = np.argmax(pr_total)
+    best_labeling = []
+    for parents, new_chars in reversed(history):
+        if new_chars[beam] >= 0:
+            best_labeling.append(new_chars[beam])
+        beam = parents[beam]
 
-        # get beam-labelings of best beams
-        best_labelings = last.sort_labelings()[:beam_width]
+    # map label string to sequence of bases
+    best_seq = ''.join([bases[label] for label in reversed(best_labeling)])
 
-        # go over best beams
-        for labeling in best_labelings:
+    return best_seq
 
-            # COPY BEAM
 
-            # probability of paths ending with a non-blank
-            pr_non_blank = log(0)
-            # in case of non-empty beam
-            if labeling:
-                # apply RNA model to the posteriors
-                if lm and len(labeling) >= len_context + 1:
-                    # TODO: Add comment on why we exclude last
-                    context = get_context(labeling, len_context, exclude_last=True)
-                    # TODO: Reconsider if RNA model should be applied here
-                    pr_dist = apply_rna_model(mat[t], context, lm, entr_cache, s_entropies[t], r_threshold, s_threshold)
-                else:
-                    pr_dist = mat[t]
-
-                pr_non_blank = last.entries[labeling].pr_non_blank + log(pr_dist[labeling[-1]])
+_logaddexp = njit(cache=True)(logaddexp)
 
-            # probability of paths ending with a blank
-            pr_blank = last.entries[labeling].pr_total + log(mat[t, blank_idx])
 
-            # fill in data for current beam
-            curr.entries[labeling].labeling = labeling
-            curr.entries[labeling].pr_non_blank = np.logaddexp(curr.entries[labeling].pr_non_blank, pr_non_blank)
-            curr.entries[labeling].pr_blank = np.logaddexp(curr.entries[labeling].pr_blank, pr_blank)
-            curr.entries[labeling].pr_total = np.logaddexp(curr.entries[labeling].pr_total,
-                                                           np.logaddexp(pr_blank, pr_non_blank))
+@njit(cache=True)
+def _bs_step(log_row, copy_dists, ext_dists, lm_applied, last_chars, last_hashes, last_tails,
+             last_pr_blank, last_pr_non_blank, last_pr_total, beam_width, beam_threshold, log_char_threshold,
+             blank_idx, n_chars, full_tail):
+    """Expand the beams of one time-step and keep the best beam_width of them.
 
-            # EXTEND BEAM
+    Each beam is identified by a hash of its labeling and only stores the encoded tail of it, the
+    labelings themselves are recovered from the returned parent beam and appended char
+    (-1 when nothing was appended) of each kept beam.
 
-            # apply RNA model to the posteriors
-            if lm and len(labeling) >= len_context:
-                context = get_context(labeling, len_context, exclude_last=False)
-                pr_dist = apply_rna_model(mat[t], context, lm, entr_cache, s_entropies[t], r_threshold, s_threshold)
+    Beams are copied and extended with the log posteriors of their row in copy_dists and
+    ext_dists, or of the only row when all beams share them. Only beams extended with the signal
+    model posteriors (see lm_applied) skip the chars below log_char_threshold.
+    """
+    n_last = last_chars.shape[0]
+    n_max = n_last * n_chars
+    shared = ext_dists.shape[0] == 1
+
+    parents = np.empty(n_max, dtype=np.int64)
+    new_chars = np.empty(n_max, dtype=np.int64)
+    chars = np.empty(n_max, dtype=np.int64)
+    hashes = np.empty(n_max, dtype=np.int64)
+    tails = np.empty(n_max, dtype=np.int64)
+    pr_blank = np.full(n_max, -np.inf)
+    pr_non_blank = np.full(n_max, -np.inf)
+    pr_total = np.full(n_max, -np.inf)
+
+    # map labeling hashes to their candidate beam, so identical labelings are merged
+    rows = Dict.empty(key_type=types.int64, value_type=types.int64)
+    n = 0
+    best_pr_total = -np.inf
+
+    for i in range(n_last):
+        last_char = last_chars[i]
+        tail = last_tails[i]
+        d = 0 if shared else i
+
+        # COPY BEAM
+        pr_nb = -np.inf
+        if last_char >= 0:
+            pr_nb = last_pr_non_blank[i] + copy_dists[d, last_char]
+        pr_b = last_pr_total[i] + log_row[blank_idx]
+
+        h = last_hashes[i]
+        if h in rows:
+            j = rows[h]
+        else:
+            j = n
+            n += 1
+            rows[h] = j
+            parents[j] = i
+            new_chars[j] = -1
+            chars[j] = last_char
+            hashes[j] = h
+            tails[j] = tail
+        pr_non_blank[j] = _logaddexp(pr_non_blank[j], pr_nb)
+        pr_blank[j] = _logaddexp(pr_blank[j], pr_b)
+        pr_total[j] = _logaddexp(pr_total[j], _logaddexp(pr_b, pr_nb))
+        best_pr_total = max(best_pr_total, pr_total[j])
+
+        # EXTEND BEAM
+        for c in range(n_chars - 1):
+            # skip chars the signal model considers unlikely, unless the RNA model could have made them likely
+            if log_row[c] < log_char_threshold and not lm_applied[d]:
+                continue
+
+            # if new labeling contains duplicate char at the end, only consider paths ending with a blank
+            if last_char == c:
+                pr_nb = last_pr_blank[i] + ext_dists[d, c]
             else:
-                pr_dist = mat[t]
-
-            # extend current beam-labeling
-            for c in range(chars - 1):
-                # add new char to current beam-labeling
-                new_labeling = labeling + (c,)
+                pr_nb = last_pr_total[i] + ext_dists[d, c]
 
-                # if new labeling contains duplicate char at the end, only consider paths ending with a blank
-                if labeling and labeling[-1] == c:
-                    pr_non_blank = last.entries[labeling].pr_blank + log(pr_dist[c])
-                else:
-                    pr_non_blank = last.entries[labeling].pr_total + log(pr_dist[c])
+            # prune beams that can't compete with the best one
+            if pr_nb < best_pr_total - beam_threshold:
+                continue
 
-                # fill in data TODO: Refactor
-                curr.entries[new_labeling].labeling = new_labeling
-                curr.entries[new_labeling].pr_non_blank = np.logaddexp(curr.entries[new_labeling].pr_non_blank,
-                                                                       pr_non_blank)
-                curr.entries[new_labeling].pr_total = np.logaddexp(curr.entries[new_labeling].pr_total, pr_non_blank)
+            new_h = h * HASH_PRIME + c + 1
+            if new_h in rows:
+                j = rows[new_h]
+            else:
+                j = n
+                n += 1
+                rows[new_h] = j
+                parents[j] = i
+                new_chars[j] = c
+                chars[j] = c
+                hashes[j] = new_h
+                # keep only the last chars needed for the RNA model context in the new tail
+                new_tail = tail * (n_chars - 1) + c
+                if tail >= full_tail:
+                    new_tail = new_tail % full_tail + full_tail
+                tails[j] = new_tail
+            pr_non_blank[j] = _logaddexp(pr_non_blank[j], pr_nb)
+            pr_total[j] = _logaddexp(pr_total[j], pr_nb)
+            best_pr_total = max(best_pr_total, pr_total[j])
+
+    # keep the best beams, ties stay in insertion order
+    best = np.argsort(-pr_total[:n], kind="mergesort")[:beam_width]
+
+    return (parents[best], new_chars[best], chars[best], hashes[best], tails[best],
+            pr_blank[best], pr_non_blank[best], pr_total[best])
+
+
+def batched_beam_search(mats: List[np.ndarray], bases: str, beam_width: int) -> List[str]:
+    """Beam search decoder without a language model, decoding a batch of matrices together.
+
+    Each time-step is expanded for all matrices of the batch at once, with the beams of a matrix
+    identified by a hash of their labeling in the same way as in beam_search.
 
-        # set new beam state
-        last = curr
+    Args:
+        mats: Outputs of neural network, each of shape TxC (T can differ between matrices).
+        bases: The set of bases the neural network can recognize, excluding the CTC-blank.
+        beam_width: Number of beams kept per iteration.
 
-    # sort by probability
-    best_labeling = last.sort_labelings()[0]
+    Returns:
+        The decoded text of each matrix.
+    """
 
-    # map label string to sequence of bases
-    best_seq = ''.join([bases[label] for label in best_labeling])
+    blank_idx = len(bases)
+    batch_size = len(mats)
+    lengths = np.array([mat.shape[0] for mat in mats], dtype=np.int64)
+    timesteps = lengths.max(initial=0)
+    chars = mats[0].shape[1] if batch_size else blank_idx + 1
+
+    # pad the matrices to the same number of time-steps
+    log_mats = np.full((batch_size, timesteps, chars), -np.inf)
+    for b, mat in enumerate(mats):
+        log_mats[b, :lengths[b]] = log_dist(mat)
+
+    # initialise beam state, only the first beam (the empty labeling) is alive
+    last_chars = np.full((batch_size, beam_width), -1)
+    hashes = np.zeros((batch_size, beam_width), dtype=np.int64)
+    pr_blank = np.full((batch_size, beam_width), -np.inf)
+    pr_non_blank = np.full((batch_size, beam_width), -np.inf)
+    pr_total = np.full((batch_size, beam_width), -np.inf)
+    pr_blank[:, 0] = log(1)
+    pr_total[:, 0] = log(1)
+
+    # candidate beams are ordered as in beam_search: for each beam, its copy and then its extensions
+    n_cand = beam_width * chars
+    cand_parents = np.repeat(np.arange(beam_width), chars)
+    cand_new_chars = np.tile(np.arange(-1, chars - 1), beam_width)
+    ext_chars = np.arange(chars - 1)
+    batch_rows = np.arange(batch_size)[:, None]
+
+    history = []
+    with np.errstate(invalid="ignore"):
+        for t in range(timesteps):
+            log_rows = log_mats[:, t]
 
-    return best_seq
\ No newline at end of file
+            # COPY BEAM
+            copy_non_blank = np.where(last_chars >= 0,
+                                      pr_non_blank + np.take_along_axis(log_rows, np.maximum(last_chars, 0), axis=1),
+                                      -np.inf)
+            copy_blank = pr_total + log_rows[:, blank_idx, None]
+
+            # EXTEND BEAM, if the new labeling ends with a duplicate char only consider paths ending with a blank
+            ext_non_blank = np.where(last_chars[:, :, None] == ext_chars,
+                                     pr_blank[:, :, None], pr_total[:, :, None]) + log_rows[:, None, :-1]
+            ext_hashes = hashes[:, :, None] * HASH_PRIME + ext_chars + 1
+
+            cand_hashes = np.concatenate((hashes[:, :, None], ext_hashes), axis=2).reshape(batch_size, n_cand)
+            cand_blank = np.concatenate((copy_blank[:, :, None], np.full(ext_non_blank.shape, -np.inf)),
+                                        axis=2).reshape(batch_size, n_cand)
+            cand_non_blank = np.concatenate((copy_non_blank[:, :, None], ext_non_blank),
+                                            axis=2).reshape(batch_size, n_cand)
+            cand_total = np.logaddexp(cand_blank, cand_non_blank)
+
+            # merge candidates with the same labeling, kept in the column of their first occurrence
+            order = np.argsort(cand_hashes, axis=1, kind="stable")
+            sorted_hashes = np.take_along_axis(cand_hashes, order, axis=1)
+            first = np.ones((batch_size, n_cand), dtype=bool)
+            first[:, 1:] = sorted_hashes[:, 1:] != sorted_hashes[:, :-1]
+            flat_order = (order + batch_rows * n_cand).ravel()
+            starts = np.flatnonzero(first.ravel())
+            merged = flat_order[starts]
+
+            merged_blank = np.full(batch_size * n_cand, -np.inf)
+            merged_non_blank = np.full(batch_size * n_cand, -np.inf)
+            merged_total = np.full(batch_size * n_cand, -np.inf)
+            merged_blank[merged] = np.logaddexp.reduceat(cand_blank.ravel()[flat_order], starts)
+            merged_non_blank[merged] = np.logaddexp.reduceat(cand_non_blank.ravel()[flat_order], starts)
+            merged_total[merged] = np.logaddexp.reduceat(cand_total.ravel()[flat_order], starts)
+
+            # keep the best beams of each matrix, ties stay in insertion order and merged
+            # duplicates are only kept (as dead beams) when there are fewer labelings than beams
+            scores = np.full(batch_size * n_cand, np.inf)
+            scores[merged] = np.where(merged_total[merged] == -np.inf, np.finfo(float).max, -merged_total[merged])
+            best = np.argsort(scores.reshape(batch_size, n_cand), axis=1, kind="stable")[:, :beam_width]
+
+            parents = cand_parents[best]
+            new_chars = cand_new_chars[best]
+            new_last_chars = np.where(new_chars >= 0, new_chars, np.take_along_axis(last_chars, parents, axis=1))
+
+            # matrices that have no time-step left keep their beams unchanged
+            active = (t < lengths)[:, None]
+            flat_best = (best + batch_rows * n_cand).ravel()
+            pr_blank = np.where(active, merged_blank[flat_best].reshape(best.shape), pr_blank)
+            pr_non_blank = np.where(active, merged_non_blank[flat_best].reshape(best.shape), pr_non_blank)
+            pr_total = np.where(active, merged_total[flat_best].reshape(best.shape), pr_total)
+            hashes = np.where(active, np.take_along_axis(cand_hashes, best, axis=1), hashes)
+            last_chars = np.where(active, new_last_chars, last_chars)
+            history.append((np.where(active, parents, np.arange(beam_width)), np.where(active, new_chars, -1)))
+
+    # trace the best beam of each matrix back to the first time-step
+    best_seqs = []
+    for b in range(batch_size):
+        beam = np.argmax(pr_total[b])
+        best_labeling = []
+        for parents, new_chars in reversed(history):
+            if new_chars[b, beam] >= 0:
+                best_labeling.append(new_chars[b, beam])
+            beam = parents[b, beam]
+
+        # map label string to sequence of bases
+        best_seqs.append(''.join([bases[label] for label in reversed(best_labeling)]))
+
+    return best_seqs
@@ -18,10 +18,11 @@ import numpy as np
 #########################Simple assembly method################################
 def simple_assembly(bpreads):
     # print(bpreads)
-    concensus = np.zeros([4, 1000])
+    # each read starts at most one read length after the previous one, so the
+    # assembly can't be longer than all the reads laid end to end
+    concensus = np.zeros([4, sum(len(bpread) for bpread in bpreads)])
     pos = 0
     length = 0
-    census_len = 1000
     for indx, bpread in enumerate(bpreads):
         if indx == 0:
             add_count(concensus, 0, bpread)
@@ -29,10 +30,6 @@ def simple_assembly(bpreads):
         d = difflib.SequenceMatcher(None, bpreads[indx - 1], bpread)
         match_block = max(d.get_matching_blocks(), key=lambda x: x[2])
         disp = match_block[0] - match_block[1]
-        if disp + pos + len(bpreads[indx]) > census_len:
-            concensus = np.lib.pad(concensus, ((0, 0), (0, 1000)),
-                                   mode='constant', constant_values=0)
-            census_len += 1000
         add_count(concensus, pos + disp, bpreads[indx])
         pos += disp
         length = max(length, pos + len(bpreads[indx]))
@@ -51,11 +48,11 @@ def add_count(concensus, start_indx, segment):
 # TODO: Delete this????
 #########################Simple assembly method with quality score################################
 def simple_assembly_qs(bpreads, qs_list):
-    concensus = np.zeros([4, 1000])
-    concensus_qs = np.zeros([4, 1000])
+    census_len = sum(len(bpread) for bpread in bpreads)
+    concensus = np.zeros([4, census_len])
+    concensus_qs = np.zeros([4, census_len])
     pos = 0
     length = 0
-    census_len = 1000
     assert len(bpreads) == len(qs_list)
     for indx, bpread in enumerate(bpreads):
         if indx == 0:
@@ -64,12 +61,6 @@ def simple_assembly_qs(bpreads, qs_list):
         d = difflib.SequenceMatcher(None, bpreads[indx - 1], bpread)
         match_block = max(d.get_matching_blocks(), key=lambda x: x[2])
         disp = match_block[0] - match_block[1]
-        if disp + pos + len(bpread) > census_len:
-            concensus = np.lib.pad(concensus, ((0, 0), (0, 1000)),
-                                   mode='constant', constant_values=0)
-            concensus_qs = np.lib.pad(concensus_qs, ((0, 0), (0, 1000)),
-                                      mode='constant', constant_values=0)
-            census_len += 1000
         add_count_qs(concensus, concensus_qs, pos + disp, bpread, qs_list[indx])
         pos += disp
         length = max(length, pos + len(bpread))